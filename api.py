@@ -2,231 +2,390 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.responses import Response
 import polars as pl
-import pandas as pd
+import orjson
 import io
+import asyncio
+import os
+import hashlib
+import tempfile
+import threading
+import xlsxwriter
+from collections import OrderedDict
 import numpy as np
 from datetime import datetime
 
 app = FastAPI()
 
-@app.post("/analyze")
-async def analyze_je(file: UploadFile = File(...)):
-    try:
-        # Read file
-        content = await file.read()
-        if file.filename.endswith(".xlsx") or file.filename.endswith(".xls"):
-            df_full = pl.from_pandas(pd.read_excel(io.BytesIO(content)))
-        else:
-            df_full = pl.read_csv(io.BytesIO(content), encoding="utf-8", infer_schema_length=10000)
+# Results of recent /analyze calls keyed by upload content hash, so /export
+# of the same file can skip the parse and anomaly pass. Bounded both by entry
+# count and by the total estimated size of the cached frames.
+_CACHE_SIZE = 8
+_CACHE_MAX_BYTES = 256 * 1024 * 1024
+_cache: "OrderedDict[str, tuple[pl.DataFrame, pl.DataFrame, int]]" = OrderedDict()
+_cache_bytes = 0
+_cache_lock = threading.Lock()
 
-        if len(df_full) == 0:
-            raise HTTPException(status_code=400, detail="File is empty")
 
-        # --- STEP 1: Calculate Net Amount ---
-        # Try to auto-detect Debit/Credit or single Amount
-        debit_candidates = [c for c in df_full.columns if "debit" in c.lower()]
-        credit_candidates = [c for c in df_full.columns if "credit" in c.lower()]
-        amount_candidates = [c for c in df_full.columns if "amount" in c.lower() or "amt" in c.lower()]
-
-        amount_series = None
-
-        # Case 1: Debit & Credit
-        if debit_candidates and credit_candidates:
-            dr_col = debit_candidates[0]
-            cr_col = credit_candidates[0]
-            dr = (
-                df_full[dr_col]
-                .cast(pl.Utf8)
-                .str.replace(",", "")
-                .cast(pl.Float64, strict=False)
-                .fill_null(0.0)
-            )
-            cr = (
-                df_full[cr_col]
-                .cast(pl.Utf8)
-                .str.replace(",", "")
-                .cast(pl.Float64, strict=False)
-                .fill_null(0.0)
-            )
-            amount_series = dr - cr  # Positive = Debit, Negative = Credit
-        # Case 2: Single Amount
-        elif amount_candidates:
-            amt_col = amount_candidates[0]
-            amount_series = df_full[amt_col].cast(pl.Float64, strict=False)
-        # Case 3: None found
+def _cache_get(key: str):
+    with _cache_lock:
+        if key not in _cache:
+            return None
+        _cache.move_to_end(key)
+        results, anomalies, _ = _cache[key]
+        return results, anomalies
+
+
+def _cache_put(key: str, results: pl.DataFrame, anomalies: pl.DataFrame):
+    global _cache_bytes
+    nbytes = results.estimated_size() + anomalies.estimated_size()
+    if nbytes > _CACHE_MAX_BYTES:
+        return  # would evict everything else and still not fit
+    with _cache_lock:
+        if key in _cache:
+            _cache_bytes -= _cache.pop(key)[2]
+        _cache[key] = (results, anomalies, nbytes)
+        _cache_bytes += nbytes
+        while len(_cache) > _CACHE_SIZE or _cache_bytes > _CACHE_MAX_BYTES:
+            _cache_bytes -= _cache.popitem(last=False)[1][2]
+
+
+# Error payload encoded with orjson, like the success responses
+def _error_response(e: Exception) -> Response:
+    return Response(
+        content=orjson.dumps({"success": False, "error": str(e)}),
+        media_type="application/json"
+    )
+
+
+# Uploads up to this size are parsed straight from memory
+_SMALL_UPLOAD = 256 * 1024
+
+
+# Spool the upload to disk in 1 MiB chunks so Polars reads from a file
+# instead of a full in-memory copy of the bytes; hash the content on the way.
+# Small uploads skip the temp file and come back as bytes.
+def _spool_upload(file: UploadFile) -> tuple[str | bytes, str]:
+    if file.size is not None and file.size <= _SMALL_UPLOAD:
+        content = file.file.read()
+        return content, hashlib.blake2b(content, digest_size=16).hexdigest()
+
+    suffix = os.path.splitext(file.filename)[1]
+    digest = hashlib.blake2b(digest_size=16)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tf:
+        try:
+            while chunk := file.file.read(1 << 20):
+                digest.update(chunk)
+                tf.write(chunk)
+        except BaseException:
+            # Callers only clean up paths we return - don't leak a partial file
+            os.remove(tf.name)
+            raise
+    return tf.name, digest.hexdigest()
+
+
+# Anomaly rules that don't depend on the upload, built once at import
+# 1. Round Large Amount
+_ROUND_EXPR = (
+    (pl.col("amount") == pl.col("amount").round(0)) & (pl.col("amount").abs() > 1000)
+).alias("Round Large Amount")
+
+# 2. Near-Zero Amount
+_NEARZERO_EXPR = (pl.col("amount").abs() < 1).alias("Near-Zero Amount")
+
+# 3. Suspicious Description
+_SUSP_DESC_EXPR = pl.col("description").str.contains_any([
+    "adjust", "misc", "manual", "override", "error", "temp",
+    "reversal", "correction", "clearing", "suspense", "miscellaneous"
+], ascii_case_insensitive=True).alias("Suspicious Description")
+
+# 4. Weekend Entry
+_WEEKEND_EXPR = (pl.col("posting_date").dt.weekday().fill_null(0) >= 6).alias("Weekend Entry")
+
+# 6. High-Value Entry (threshold evaluated inside the plan)
+_HIGH_VALUE_EXPR = (
+    pl.when(pl.len() > 10)
+    .then(pl.col("amount").abs() >= pl.col("amount").abs().quantile(0.99))
+    .otherwise(False)
+    .alias("High-Value Entry")
+)
+
+# 7. Repeating Entry
+_REPEATING_EXPR = (pl.len().over(["account", "amount", "description"]) > 1).alias("Repeating Entry")
+
+
+# Steps 1-7 of /analyze: plain synchronous Polars work, run off the event loop
+def _run_pipeline(df_full: pl.DataFrame, digest: str) -> memoryview:
+    # --- STEP 1: Calculate Net Amount ---
+    # Try to auto-detect Debit/Credit or single Amount
+    # Lowercase column names once; find() returns the first matching original name
+    lowered = [(c, c.lower()) for c in df_full.columns]
+
+    def find_any(subs):
+        return next((orig for orig, lo in lowered if any(sub in lo for sub in subs)), None)
+
+    def find(sub):
+        return find_any((sub,))
+
+    dr_col = find("debit")
+    cr_col = find("credit")
+    amt_col = find_any(("amount", "amt"))
+
+    amount_expr = None
+
+    # Numeric columns are cast as-is; text ones (e.g. "1,500.00") get $, commas
+    # and spaces stripped in one regex pass before casting
+    def to_amount(col):
+        if df_full.schema[col].is_numeric():
+            return pl.col(col).cast(pl.Float64)
+        return (
+            pl.col(col)
+            .cast(pl.Utf8)
+            .str.replace_all(r"[,$\s]", "")
+            .cast(pl.Float64, strict=False)
+        )
+
+    # Case 1: Debit & Credit
+    if dr_col and cr_col:
+        dr = to_amount(dr_col).fill_null(0.0)
+        cr = to_amount(cr_col).fill_null(0.0)
+        amount_expr = dr - cr  # Positive = Debit, Negative = Credit
+    # Case 2: Single Amount
+    elif amt_col:
+        amount_expr = to_amount(amt_col)
+    # Case 3: None found
+    else:
+        raise HTTPException(status_code=400, detail="No amount column found (looked for 'amount', 'debit', 'credit')")
+
+    # --- STEP 2: Choose Primary Date ---
+    date_col = find_any(("date", "effective", "posted"))
+
+    # --- Build Lazy Plan ---
+    # Everything below is one expression graph, collected once at the end
+    lf = df_full.lazy()
+    select_list = [amount_expr.alias("amount")]
+    if date_col:
+        select_list.append(pl.col(date_col).alias("posting_date"))
+
+    # Add key fields if present
+    for col, alias in [
+        ("account", "account"),
+        ("description", "description"),
+        ("je_id", "je_id"),
+        ("created_by", "created_by"),
+        ("posted_by", "posted_by"),
+        ("cost_center", "cost_center"),
+        ("project", "project")
+    ]:
+        match = find(col)
+        if match:
+            select_list.append(pl.col(match).alias(alias))
+
+    lf = lf.select(select_list)
+    columns = lf.collect_schema().names()
+    has_date = "posting_date" in columns
+
+    # --- Smart Date Parsing ---
+    if has_date:
+        if df_full.schema[date_col].is_temporal():
+            # Already temporal (e.g. Excel dates) - keep as-is
+            lf = lf.with_columns(pl.col("posting_date").cast(pl.Datetime, strict=False))
         else:
-            raise HTTPException(status_code=400, detail="No amount column found (looked for 'amount', 'debit', 'credit')")
-
-        # --- STEP 2: Choose Primary Date ---
-        date_col = None
-        date_candidates = [c for c in df_full.columns if "date" in c.lower() or "effective" in c.lower() or "posted" in c.lower()]
-        if date_candidates:
-            date_col = date_candidates[0]
-
-        # --- Build Final DataFrame ---
-        select_list = [amount_series.alias("amount")]
-        if date_col:
-            select_list.append(pl.col(date_col).alias("posting_date"))
-
-        # Add key fields if present
-        for col, alias in [
-            ("account", "account"),
-            ("description", "description"),
-            ("je_id", "je_id"),
-            ("created_by", "created_by"),
-            ("posted_by", "posted_by"),
-            ("cost_center", "cost_center"),
-            ("project", "project")
-        ]:
-            candidates = [c for c in df_full.columns if col in c.lower()]
-            if candidates:
-                select_list.append(pl.col(candidates[0]).alias(alias))
-
-        selected = df_full.select(select_list)
-
-        # --- Smart Date Parsing ---
-        if "posting_date" in selected.columns:
+            # Text, or numbers like 20240106 - parse as text via the format list
             date_formats = [
                 "%Y-%m-%d", "%d-%b-%Y", "%d-%b-%y", "%m/%d/%Y", "%d/%m/%Y",
                 "%Y%m%d", "%B %d, %Y", "%b %d, %Y", "%d-%m-%Y", "%m-%d-%Y"
             ]
-            parsed = None
-            for fmt in date_formats:
-                try:
-                    parsed = pl.col("posting_date").str.strptime(pl.Datetime, fmt, strict=False)
-                    selected = selected.with_columns(parsed)
-                    break
-                except:
-                    continue
-            if parsed is None:
-                selected = selected.drop(["posting_date"]) if "posting_date" in selected.columns else selected
-
-        # --- Clean Invalid Rows ---
-        cleaned = selected.filter(pl.col("amount").is_not_null())
-        if "posting_date" in cleaned.columns:
-            cleaned = cleaned.filter(pl.col("posting_date").is_not_null())
-
-        # --- ANOMALY DETECTION ---
-        anomaly_exprs = []
-
-        # 1. Round Large Amount
-        anomaly_exprs.append(
-            ((pl.col("amount").abs() % 1 == 0) & (pl.col("amount").abs() > 1000)).alias("Round Large Amount")
-        )
+            # Use one format for the whole column - whichever parses the most
+            # rows - so ambiguous dates like 06/01/2024 are read consistently.
+            # Counting is a small aggregate up front; only the winner is applied
+            def parse(fmt):
+                return pl.col("posting_date").cast(pl.Utf8).str.strptime(pl.Datetime, fmt, strict=False)
 
-        # 2. Near-Zero Amount
-        anomaly_exprs.append(
-            (pl.col("amount").abs() < 1).alias("Near-Zero Amount")
-        )
+            counts = lf.select([parse(fmt).count().alias(fmt) for fmt in date_formats]).collect().row(0)
+            best = max(range(len(date_formats)), key=lambda i: (counts[i], -i))  # ties: earlier format
+            if counts[best] > 0:
+                lf = lf.with_columns(parse(date_formats[best]).alias("posting_date"))
+            else:
+                # Nothing parsed - ignore the date rather than dropping every row
+                lf = lf.drop("posting_date")
+                columns.remove("posting_date")
+                has_date = False
 
-        # 3. Suspicious Description
-        if "description" in cleaned.columns:
-            anomaly_exprs.append(
-                pl.col("description").str.to_lowercase().is_in([
-                    "adjust", "misc", "manual", "override", "error", "temp",
-                    "reversal", "correction", "clearing", "suspense", "miscellaneous"
-                ]).alias("Suspicious Description")
-            )
-        else:
-            anomaly_exprs.append(pl.lit(False).alias("Suspicious Description"))
+    # --- Clean Invalid Rows ---
+    lf = lf.filter(
+        pl.col("amount").is_not_null()
+        & (pl.col("posting_date").is_not_null() if has_date else pl.lit(True))
+    )
 
-        # 4. Weekend Entry
-        if "posting_date" in cleaned.columns:
-            anomaly_exprs.append(
-                (pl.col("posting_date").dt.weekday() >= 6).fill_null(False).alias("Weekend Entry")
-            )
-        else:
-            anomaly_exprs.append(pl.lit(False).alias("Weekend Entry"))
-
-        # 5. Duplicate Entry (all non-amount columns)
-        group_keys = [col for col in cleaned.columns if col != "amount"]
-        if len(group_keys) > 0:
-            anomaly_exprs.append(
-                pl.struct(group_keys).is_duplicated().alias("Duplicate Entry")
-            )
-        else:
-            anomaly_exprs.append(pl.lit(False).alias("Duplicate Entry"))
-
-        # 6. High-Value Entry
-        if len(cleaned) > 10:
-            threshold = cleaned.select(pl.col("amount").abs().quantile(0.99)).item()
-            anomaly_exprs.append(
-                (pl.col("amount").abs() >= threshold).alias("High-Value Entry")
-            )
-        else:
-            anomaly_exprs.append(pl.lit(False).alias("High-Value Entry"))
+    # --- ANOMALY DETECTION ---
+    # 1-4: row-wise rules, falling back to False when the column is missing
+    anomaly_exprs = [
+        _ROUND_EXPR,
+        _NEARZERO_EXPR,
+        _SUSP_DESC_EXPR if "description" in columns else pl.lit(False).alias("Suspicious Description"),
+        _WEEKEND_EXPR if has_date else pl.lit(False).alias("Weekend Entry"),
+    ]
 
-        # 7. Repeating Entry
-        if "description" in cleaned.columns and "account" in cleaned.columns:
-            anomaly_exprs.append(
-                pl.struct(["account", "amount", "description"]).is_duplicated().alias("Repeating Entry")
-            )
-        else:
-            anomaly_exprs.append(pl.lit(False).alias("Repeating Entry"))
-
-        # Build results
-        results = cleaned.with_columns(anomaly_exprs)
-        anomaly_cols = [col for col in results.columns if col != "amount" and col != "Has Anomaly" and "Entry" in col]
-        results = results.with_columns(pl.any_horizontal(anomaly_cols).alias("Has Anomaly"))
-        anomalies = results.filter(pl.col("Has Anomaly"))
-
-        # --- SUMMARY ---
-        total_net = results["amount"].sum()
-        abs_total = results["amount"].abs().sum()
-        imbalance_pct = abs(total_net) / (abs_total + 1e-6) * 100
-
-        # --- Return JSON ---
-        return {
-            "success": True,
-            "summary": {
-                "Total Entries": len(results),
-                "Net Balance": round(float(total_net), 2),
-                "Imbalance %": round(imbalance_pct, 2),
-                "Anomalies Found": len(anomalies)
-            },
-            "charts": {
-                "anomalies": {col: anomalies.filter(pl.col(col)).height for col in anomaly_cols}
-            },
-            "anomalies_data": anomalies.to_dicts()
+    lf = lf.with_columns(anomaly_exprs)
+
+    # 5. Duplicate Entry (all non-amount columns) - the only rule built per request
+    group_keys = [col for col in columns if col != "amount"]
+    if len(group_keys) > 0:
+        duplicate_expr = (pl.len().over(group_keys) > 1).alias("Duplicate Entry")
+    else:
+        duplicate_expr = pl.lit(False).alias("Duplicate Entry")
+
+    # 6-7: window rules
+    window_exprs = [
+        duplicate_expr,
+        _HIGH_VALUE_EXPR,
+        _REPEATING_EXPR if "description" in columns and "account" in columns
+        else pl.lit(False).alias("Repeating Entry"),
+    ]
+
+    # Build results
+    anomaly_cols = [expr.meta.output_name() for expr in anomaly_exprs + window_exprs]
+    anomaly_cols = [col for col in anomaly_cols if "Entry" in col]
+    results_lf = lf.with_columns(window_exprs).with_columns(
+        pl.any_horizontal(anomaly_cols).alias("Has Anomaly")
+    )
+    anomalies_lf = results_lf.filter(pl.col("Has Anomaly"))
+
+    # --- SUMMARY ---
+    # Totals and per-flag counts in a single aggregation pass
+    summary_lf = results_lf.select([
+        pl.col("amount").sum().alias("net"),
+        pl.col("amount").abs().sum().alias("abs_sum"),
+        pl.len().alias("n"),
+        *[pl.col(col).sum().alias(f"n_{col}") for col in anomaly_cols],
+        pl.col("Has Anomaly").sum().alias("n_anom"),
+    ])
+
+    results, anomalies, summary = pl.collect_all([results_lf, anomalies_lf, summary_lf])
+    _cache_put(digest, results, anomalies)
+    agg = summary.row(0, named=True)
+    total_net = agg["net"]
+    abs_total = agg["abs_sum"]
+    imbalance_pct = abs(total_net) / (abs_total + 1e-6) * 100
+    net_balance, imbalance_pct = np.round([total_net, imbalance_pct], 2).tolist()
+
+    # --- Return JSON ---
+    # anomalies_data can be large: serialize it straight from Arrow and splice
+    # it into the payload instead of going through to_dicts()
+    head = orjson.dumps({
+        "success": True,
+        "summary": {
+            "Total Entries": agg["n"],
+            "Net Balance": net_balance,
+            "Imbalance %": imbalance_pct,
+            "Anomalies Found": agg["n_anom"]
+        },
+        "charts": {
+            "anomalies": {col: agg[f"n_{col}"] for col in anomaly_cols}
         }
+    })
+    # Datetimes as isoformat() writes them: 6-digit microseconds, omitted when zero
+    iso = pl.col(pl.Datetime)
+    anomalies = anomalies.with_columns(
+        pl.when(iso.dt.microsecond() == 0)
+        .then(iso.dt.strftime("%Y-%m-%dT%H:%M:%S"))
+        .otherwise(iso.dt.strftime("%Y-%m-%dT%H:%M:%S%.6f"))
+    )
+    # Write everything into one buffer to avoid extra copies of a large payload
+    buf = io.BytesIO()
+    buf.write(head[:-1] + b',"anomalies_data":')
+    anomalies.write_json(buf)
+    buf.write(b"}")
+    return buf.getbuffer()
+
+
+@app.post("/analyze")
+async def analyze_je(file: UploadFile = File(...)):
+    try:
+        # Read file (blocking I/O and parsing go to a worker thread)
+        source, digest = await asyncio.to_thread(_spool_upload, file)
+        try:
+            if file.filename.endswith(".xlsx") or file.filename.endswith(".xls"):
+                df_full = await asyncio.to_thread(
+                    pl.read_excel, source, engine="calamine", infer_schema_length=10000
+                )
+            else:
+                df_full = await asyncio.to_thread(
+                    pl.read_csv, source, encoding="utf-8", infer_schema_length=10000,
+                    try_parse_dates=False, low_memory=False
+                )
+        finally:
+            if isinstance(source, str):
+                os.remove(source)
+
+        if len(df_full) == 0:
+            raise HTTPException(status_code=400, detail="File is empty")
+
+        payload = await asyncio.to_thread(_run_pipeline, df_full, digest)
+        return Response(content=payload, media_type="application/json")
 
     except Exception as e:
-        return {"success": False, "error": str(e)}
+        return _error_response(e)
+
+
+# Build the export workbook; blocking, so called via asyncio.to_thread
+def _build_report(cached, df: pl.DataFrame | None) -> bytes:
+    excel_buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(excel_buffer, {"in_memory": True})
+    if cached is not None:
+        # Reuse what /analyze computed for this exact file
+        results, anomalies = cached
+        results.write_excel(workbook=workbook, worksheet="All Transactions")
+        pl.DataFrame({
+            "Metric": ["Total Entries", "Anomalies Found"],
+            "Value": [len(results), len(anomalies)]
+        }).write_excel(workbook=workbook, worksheet="Summary")
+        anomalies.write_excel(workbook=workbook, worksheet="Anomalies")
+    else:
+        # File was not analyzed yet - export the raw data only
+        # Sheet 1: All Data
+        df.write_excel(workbook=workbook, worksheet="All Transactions")
+
+        # Sheet 2: Summary
+        pl.DataFrame({
+            "Metric": ["Total Entries"],
+            "Value": [len(df)]
+        }).write_excel(workbook=workbook, worksheet="Summary")
+
+        # Sheet 3: Sample Anomalies (mock)
+        if "Amount" in df.columns:
+            df.head(50).with_columns(
+                pl.lit("Round Amount").alias("Anomaly")
+            ).write_excel(workbook=workbook, worksheet="Anomalies")
+    workbook.close()
+    return excel_buffer.getvalue()
 
 
 @app.post("/export")
 async def export_report(file: UploadFile = File(...)):
     try:
-        content = await file.read()
-        if file.filename.endswith(".xlsx"):
-            df = pl.from_pandas(pd.read_excel(io.BytesIO(content)))
-        else:
-            df = pl.read_csv(io.BytesIO(content), encoding="utf-8")
-
-        # Re-run logic to get results (in production, cache or reuse)
-        # For brevity, we'll export sample sheets
-        excel_buffer = io.BytesIO()
-        with pd.ExcelWriter(excel_buffer, engine="openpyxl") as writer:
-            # Sheet 1: All Data
-            df.to_pandas().to_excel(writer, index=False, sheet_name="All Transactions")
-
-            # Sheet 2: Summary
-            pd.DataFrame([{
-                "Metric": "Total Entries",
-                "Value": len(df)
-            }]).to_excel(writer, index=False, sheet_name="Summary")
-
-            # Sheet 3: Sample Anomalies (mock)
-            if "Amount" in df.columns:
-                sample_anomalies = df.to_pandas().head(50)
-                sample_anomalies["Anomaly"] = "Round Amount"
-                pd.DataFrame(sample_anomalies).to_excel(writer, index=False, sheet_name="Anomalies")
-
-        excel_buffer.seek(0)
+        source, digest = await asyncio.to_thread(_spool_upload, file)
+        df = None
+        try:
+            cached = _cache_get(digest)
+            if cached is None:
+                if file.filename.endswith(".xlsx"):
+                    df = await asyncio.to_thread(
+                        pl.read_excel, source, engine="calamine", infer_schema_length=10000
+                    )
+                else:
+                    df = await asyncio.to_thread(
+                        pl.read_csv, source, encoding="utf-8", try_parse_dates=False, low_memory=False
+                    )
+        finally:
+            if isinstance(source, str):
+                os.remove(source)
+
+        report = await asyncio.to_thread(_build_report, cached, df)
         return Response(
-            content=excel_buffer.getvalue(),
+            content=report,
             media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             headers={"Content-Disposition": f"attachment; filename=je_audit_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"}
         )
     except Exception as e:
-        return {"success": False, "error": str(e)}
\ No newline at end of file
+        return _error_response(e)
\ No newline at end of file